@@ -4,10 +4,15 @@ Main entry point: orchestrates the full AI sticker generation pipeline.
 """
 
 import os
-import uuid
+import json
 import time
+import secrets
+import hashlib
+import threading
 import traceback
-from flask import Flask, request, jsonify, send_file, send_from_directory
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, request, jsonify, send_file, send_from_directory
 from flask_cors import CORS
 from dotenv import load_dotenv
 
@@ -26,6 +31,143 @@ CORS(app)
 OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "output")
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+# Behind nginx (see deploy/nginx.conf), set e.g. "/internal_output" so
+# downloads are delegated to the proxy instead of streamed through Python
+X_ACCEL_PREFIX = os.getenv("X_ACCEL_REDIRECT_PREFIX", "").rstrip("/")
+
+# Phrase -> (response, output files) LRU cache for repeated text-only requests
+RESULT_CACHE_SIZE = 512
+_result_cache = OrderedDict()
+_result_cache_lock = threading.Lock()
+
+
+def _phrase_key(phrase: str) -> str:
+    normalized = phrase.lower().strip().encode("utf-8")
+    return hashlib.blake2b(normalized, digest_size=16).hexdigest()
+
+
+def _cache_get(key: str):
+    """Return a cached response if all of its output files still exist."""
+    with _result_cache_lock:
+        entry = _result_cache.get(key)
+        if entry is None:
+            return None
+        response, paths = entry
+        if not all(os.path.exists(p) for p in paths):
+            del _result_cache[key]
+            return None
+        _result_cache.move_to_end(key)
+        return response
+
+
+def _cache_put(key: str, response: dict, paths: list):
+    with _result_cache_lock:
+        _result_cache[key] = (response, [p for p in paths if p])
+        _result_cache.move_to_end(key)
+        while len(_result_cache) > RESULT_CACHE_SIZE:
+            _result_cache.popitem(last=False)
+
+
+def _to_url(path: str) -> str:
+    """Relative URL of an output file for the frontend."""
+    if path and os.path.exists(path):
+        rel = os.path.relpath(path, os.path.dirname(__file__))
+        return "/" + rel.replace("\\", "/")
+    return None
+
+
+# ── Background Finalization ──────────────────────────────────────────────────
+# EARCP verification and exports run after /api/generate has answered. Their
+# result is written next to the session files, so /api/status works no matter
+# which worker process handles the poll.
+
+_finalize_pool = ThreadPoolExecutor(max_workers=4)
+# A session with no status file after this long (since its last write) is
+# reported as failed, e.g. when the worker running it was restarted
+FINALIZE_TIMEOUT_S = 150
+
+
+def _status_path(session_id: str) -> str:
+    return os.path.join(OUTPUT_DIR, session_id, f"{session_id}_status.json")
+
+
+def _write_status(session_id: str, payload: dict):
+    path = _status_path(session_id)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(payload, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _finalize_sticker(
+    response: dict,
+    phrase: str,
+    parsed: dict,
+    image_path: str,
+    audio_path: str,
+    gif_path: str,
+    audio_duration: float,
+    animation_result: dict,
+    session_dir: str,
+    start_time: float,
+    cache_key: str,
+):
+    """Steps 5-6: EARCP verification and exports, then publish the result."""
+    session_id = response["session_id"]
+    try:
+        # ── Step 5: EARCP Verification ────────────────────────────
+        earcp_report = verify_sticker(
+            original_phrase=phrase,
+            parsed=parsed,
+            image_path=image_path,
+            audio_path=audio_path,
+            gif_path=gif_path,
+            audio_duration_s=audio_duration,
+            animation_result=animation_result,
+        )
+
+        # ── Step 6: Export formats ────────────────────────────────
+        exports = export_all_formats(
+            animation_result=animation_result,
+            audio_mp3_path=audio_path,
+            session_id=session_id,
+            output_dir=session_dir,
+        )
+
+        elapsed = round(time.time() - start_time, 2)
+        print(f"[{session_id}] === Pipeline Done in {elapsed}s ===\n")
+
+        result = {
+            **response,
+            "elapsed_s": elapsed,
+            "sticker": {
+                **response["sticker"],
+                "url": _to_url(exports.get("webm", "")),  # The talking sticker WebM
+            },
+            "export_urls": {
+                "webm": _to_url(exports.get("webm", "")),
+                "gif": _to_url(exports.get("gif", "")),
+                "webp": _to_url(exports.get("webp", "")),
+            },
+            "earcp_report": earcp_report,
+            "earcp_pending": False,
+        }
+        _write_status(session_id, result)
+        if cache_key:
+            _cache_put(cache_key, result, [image_path, gif_path, *exports.values()])
+    except Exception as e:
+        tb = traceback.format_exc()
+        print(f"[{session_id}] ERROR: {e}\n{tb}")
+        _write_status(
+            session_id,
+            {
+                "success": False,
+                "session_id": session_id,
+                "error": str(e),
+                "traceback": tb,
+            },
+        )
+
 
 # ── Static Frontend ──────────────────────────────────────────────────────────
 
@@ -69,9 +211,17 @@ def generate():
     if len(phrase) > 500:
         return jsonify({"error": "Phrase too long (max 500 chars)"}), 400
 
+    # Text-only requests are deterministic enough to reuse a previous result
+    cache_key = None if avatar_file else _phrase_key(phrase)
+    if cache_key:
+        cached = _cache_get(cache_key)
+        if cached:
+            print(f"[Cache] Hit for phrase key {cache_key}")
+            return jsonify({**cached, "cached": True})
+
     try:
         # ── Setup session ────────────────────────────────────────
-        session_id = str(uuid.uuid4())[:8]
+        session_id = secrets.token_hex(4)
         session_dir = os.path.join(OUTPUT_DIR, session_id)
         os.makedirs(session_dir, exist_ok=True)
 
@@ -88,30 +238,44 @@ def generate():
         print(f"[{session_id}] Parsed Subject: {parsed.get('subject')}")
         print(f"[{session_id}] Parsed Emotion: {parsed.get('emotion')}")
 
-        # ── Step 2: Handle Image (AI or Upload) ──────────────────
-        if avatar_file:
-            print(f"[{session_id}] Using uploaded avatar photo")
-            image_path = os.path.join(
-                session_dir, f"{session_id}_avatar_{avatar_file.filename}"
-            )
-            avatar_file.save(image_path)
-        else:
-            print(f"[{session_id}] Generating AI Image...")
-            image_path = generate_sticker_image(
-                image_prompt=parsed["image_prompt"],
+        # Steps 2 and 3 only depend on `parsed`, so the voice is synthesized
+        # while the image is generated (both are network-bound)
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            # ── Step 3: Generate voice (Expressive Bark) ──────────
+            tts_future = pool.submit(
+                generate_voice,
+                text=parsed["speech_text"],
                 session_id=session_id,
                 output_dir=session_dir,
+                use_expressive=True,
             )
 
-        # ── Step 3: Generate voice (Expressive Bark) ──────────────
-        tts_result = generate_voice(
-            text=parsed["speech_text"],
-            session_id=session_id,
-            output_dir=session_dir,
-            use_expressive=True,
-        )
+            # ── Step 2: Handle Image (AI or Upload) ──────────────
+            if avatar_file:
+                print(f"[{session_id}] Using uploaded avatar photo")
+                image_path = os.path.join(
+                    session_dir, f"{session_id}_avatar_{avatar_file.filename}"
+                )
+                avatar_file.save(image_path)
+            else:
+                print(f"[{session_id}] Generating AI Image...")
+                image_future = pool.submit(
+                    generate_sticker_image,
+                    image_prompt=parsed["image_prompt"],
+                    session_id=session_id,
+                    output_dir=session_dir,
+                )
+                image_path, placeholder = image_future.result()
+                if placeholder:
+                    # No model answered — don't pin the placeholder sticker
+                    cache_key = None
+
+            tts_result = tts_future.result()
         audio_path = tts_result["mp3_path"]
         audio_duration = tts_result["duration_estimate_s"]
+        if tts_result.get("fallback"):
+            # Bark was wanted but unavailable — don't pin the stand-in voice
+            cache_key = None
 
         # ── Step 4: Create animation ──────────────────────────────
         animation_result = create_animated_sticker(
@@ -123,69 +287,57 @@ def generate():
         )
         gif_path = animation_result["gif_path"]
 
-        # ── Step 5: EARCP Verification ────────────────────────────
-        earcp_report = verify_sticker(
-            original_phrase=phrase,
+        elapsed = round(time.time() - start_time, 2)
+        print(f"[{session_id}] === Preview ready in {elapsed}s ===")
+
+        # Primary unified sticker = WebM with audio embedded (pending)
+        preview_gif = gif_path  # for inline preview (faster to load)
+
+        response = {
+            "success": True,
+            "session_id": session_id,
+            "elapsed_s": elapsed,
+            "parsed": {
+                "subject": parsed["subject"],
+                "emotion": parsed["emotion"],
+                "speech_text": parsed["speech_text"],
+                "animation_style": parsed["animation_style"],
+                "language": tts_result["language"],
+            },
+            # PRIMARY: unified talking sticker (animation + voice in one file)
+            "sticker": {
+                "url": None,  # The talking sticker WebM, set once exported
+                "preview_gif": _to_url(preview_gif),  # GIF for quick browser preview
+                "preview_image": _to_url(image_path),
+                "type": "webm",
+                "has_audio": True,
+                "description": "Talking Sticker (Native WebM)",
+            },
+            # SECONDARY: additional export formats
+            "export_urls": {},
+            "earcp_report": None,
+            "earcp_pending": True,
+            "status_url": f"/api/status/{session_id}",
+        }
+
+        # ── Steps 5 & 6 run in the background ─────────────────────
+        # The client can already show the preview; the EARCP report and
+        # export URLs are polled from /api/status/<session_id>
+        _finalize_pool.submit(
+            _finalize_sticker,
+            response=response,
+            phrase=phrase,
             parsed=parsed,
             image_path=image_path,
             audio_path=audio_path,
             gif_path=gif_path,
-            audio_duration_s=audio_duration,
+            audio_duration=audio_duration,
             animation_result=animation_result,
+            session_dir=session_dir,
+            start_time=start_time,
+            cache_key=cache_key,
         )
-
-        # ── Step 6: Export formats ────────────────────────────────
-        exports = export_all_formats(
-            animation_result=animation_result,
-            audio_mp3_path=audio_path,
-            session_id=session_id,
-            output_dir=session_dir,
-        )
-
-        elapsed = round(time.time() - start_time, 2)
-        print(f"[{session_id}] === Pipeline Done in {elapsed}s ===\n")
-
-        # Build response with relative URLs for frontend
-        def to_url(path: str) -> str:
-            if path and os.path.exists(path):
-                rel = os.path.relpath(path, os.path.dirname(__file__))
-                return "/" + rel.replace("\\", "/")
-            return None
-
-        # Primary unified sticker = WebM with audio embedded
-        unified_webm = exports.get("webm", "")
-        preview_gif = gif_path  # for inline preview (faster to load)
-
-        return jsonify(
-            {
-                "success": True,
-                "session_id": session_id,
-                "elapsed_s": elapsed,
-                "parsed": {
-                    "subject": parsed["subject"],
-                    "emotion": parsed["emotion"],
-                    "speech_text": parsed["speech_text"],
-                    "animation_style": parsed["animation_style"],
-                    "language": tts_result["language"],
-                },
-                # PRIMARY: unified talking sticker (animation + voice in one file)
-                "sticker": {
-                    "url": to_url(unified_webm),  # The talking sticker WebM
-                    "preview_gif": to_url(preview_gif),  # GIF for quick browser preview
-                    "preview_image": to_url(image_path),
-                    "type": "webm",
-                    "has_audio": True,
-                    "description": "Talking Sticker (Native WebM)",
-                },
-                # SECONDARY: additional export formats
-                "export_urls": {
-                    "webm": to_url(exports.get("webm", "")),
-                    "gif": to_url(exports.get("gif", "")),
-                    "webp": to_url(exports.get("webp", "")),
-                },
-                "earcp_report": earcp_report,
-            }
-        )
+        return jsonify(response)
     except Exception as e:
         tb = traceback.format_exc()
         print(f"[{session_id}] ERROR: {e}\n{tb}")
@@ -199,6 +351,39 @@ def generate():
         ), 500
 
 
+# ── Background Status ────────────────────────────────────────────────────────
+
+
+@app.route("/api/status/<session_id>", methods=["GET"])
+def sticker_status(session_id):
+    """Poll the EARCP report and export URLs of a generated sticker."""
+    if not session_id.isalnum():
+        return jsonify({"error": "Invalid session"}), 400
+
+    status_path = _status_path(session_id)
+    if os.path.exists(status_path):
+        with open(status_path, encoding="utf-8") as f:
+            result = json.load(f)
+        return jsonify(result), 200 if result.get("success") else 500
+
+    session_dir = os.path.join(OUTPUT_DIR, session_id)
+    if os.path.isdir(session_dir):
+        if time.time() - os.path.getmtime(session_dir) > FINALIZE_TIMEOUT_S:
+            return jsonify(
+                {
+                    "success": False,
+                    "session_id": session_id,
+                    "earcp_pending": False,
+                    "error": "Verification and exports did not finish in time",
+                }
+            ), 500
+        return jsonify(
+            {"success": True, "session_id": session_id, "earcp_pending": True}
+        )
+
+    return jsonify({"error": f"Unknown session: {session_id}"}), 404
+
+
 # ── File Serving ─────────────────────────────────────────────────────────────
 
 
@@ -225,15 +410,25 @@ def download_sticker(session_id, format):
     if not os.path.exists(filepath):
         return jsonify({"error": f"File not found: {filename}"}), 404
 
+    download_name = f"chattysticker_{session_id}.{format}"
+    if X_ACCEL_PREFIX:
+        # nginx serves the file itself with sendfile(2), zero userspace copies
+        resp = Response(mimetype=allowed_formats[format])
+        resp.headers["X-Accel-Redirect"] = f"{X_ACCEL_PREFIX}/{session_id}/{filename}"
+        resp.headers["Content-Disposition"] = f"attachment; filename={download_name}"
+        return resp
+
     return send_file(
         filepath,
         mimetype=allowed_formats[format],
         as_attachment=True,
-        download_name=f"chattysticker_{session_id}.{format}",
+        download_name=download_name,
+        conditional=True,
     )
 
 
 if __name__ == "__main__":
+    # Development server only — production runs under gunicorn (see wsgi.py)
     print("=" * 60)
     print("  ChattyStickers — AI Animated Talking Sticker Generator")
     print("  http://localhost:5000")
@@ -199,6 +199,7 @@ async function generateSticker() {
             currentSessionId = data.session_id;
             currentExports = data.export_urls || {};
             showResult(data);
+            if (data.earcp_pending) pollStickerStatus(data.session_id);
         }
 
     } catch (err) {
@@ -213,11 +214,60 @@ async function generateSticker() {
     }
 }
 
+// ── Background Verification & Exports ────────────────────────────────────────
+// /api/generate answers as soon as the preview exists; the EARCP report and
+// the exported files are fetched here once the server has finished them.
+// The server gives up on a session after 150s, so this outlasts it.
+async function pollStickerStatus(sessionId) {
+    for (let attempt = 0; attempt < 180; attempt++) {
+        await sleep(1000);
+        if (sessionId !== currentSessionId) return; // a newer sticker replaced it
+        try {
+            const response = await fetch(`/api/status/${sessionId}`);
+            const data = await response.json();
+            if (data.earcp_pending) continue;
+            if (!response.ok || !data.success) {
+                showFinalizeFailed(sessionId, data.error || "Finalization failed", data.traceback);
+                return;
+            }
+            currentExports = data.export_urls || {};
+            showResult(data, false);
+            return;
+        } catch (err) {
+            // Transient network error — keep polling
+        }
+    }
+    if (sessionId === currentSessionId) {
+        showFinalizeFailed(sessionId, "Verification and exports are taking too long");
+    }
+}
+
+// Replace the pending panels so the preview doesn't look busy forever
+function showFinalizeFailed(sessionId, message, detail) {
+    const container = document.getElementById("earcpContent");
+    if (container) {
+        container.innerHTML = `<div class="earcp-pending earcp-failed">⚠️ Quality verification unavailable — generate again to retry.</div>`;
+    }
+    renderExports({}, sessionId);
+    stopStickerVideo();
+    showError(message, detail);
+}
+
+// The video element loops with sound; hiding it alone keeps the previous
+// sticker's voice playing behind a GIF preview
+function stopStickerVideo() {
+    const videoEl = document.getElementById("stickerVideo");
+    if (!videoEl) return;
+    videoEl.pause();
+    videoEl.removeAttribute("src");
+    videoEl.load();
+}
+
 // ── Show Result ──────────────────────────────────────────────────────────────
-function showResult(data) {
+function showResult(data, scroll = true) {
     const resultSection = document.getElementById("resultSection");
     resultSection.style.display = "block";
-    resultSection.scrollIntoView({ behavior: "smooth", block: "start" });
+    if (scroll) resultSection.scrollIntoView({ behavior: "smooth", block: "start" });
 
     const sticker = data.sticker || {};
     const exportUrls = data.export_urls || {};
@@ -247,6 +297,7 @@ function showResult(data) {
         });
     } else if (gifUrl) {
         // Fallback to GIF
+        stopStickerVideo();
         gifEl.src = gifUrl + "?t=" + Date.now();
         gifEl.style.display = "block";
         videoEl.style.display = "none";
@@ -288,10 +339,14 @@ function showResult(data) {
     }
 
     // ── EARCP Report ───────────────────────────────────────────────────────
-    renderEARCPReport(data.earcp_report || {});
+    if (data.earcp_pending) {
+        renderEARCPPending();
+    } else {
+        renderEARCPReport(data.earcp_report || {});
+    }
 
     // ── Export buttons ─────────────────────────────────────────────────────
-    renderExports(exportUrls, data.session_id);
+    renderExports(exportUrls, data.session_id, data.earcp_pending);
 }
 
 // ── Audio toggle for the unified sticker video ────────────────────────────────
@@ -312,6 +367,12 @@ function updateAudioToggleUI(isMuted) {
 
 
 // ── EARCP Report Renderer ────────────────────────────────────────────────────
+function renderEARCPPending() {
+    const container = document.getElementById("earcpContent");
+    if (!container) return;
+    container.innerHTML = `<div class="earcp-pending">🛡️ Quality verification in progress...</div>`;
+}
+
 function renderEARCPReport(report) {
     const container = document.getElementById("earcpContent");
     if (!container) return;
@@ -395,7 +456,7 @@ function gradeToColor(letter) {
 }
 
 // ── Export Buttons Renderer ──────────────────────────────────────────────────
-function renderExports(exportUrls, sessionId) {
+function renderExports(exportUrls, sessionId, pending = false) {
     const grid = document.getElementById("exportGrid");
     if (!grid) return;
 
@@ -431,7 +492,7 @@ function renderExports(exportUrls, sessionId) {
         <div class="export-btn ${f.color}" style="opacity:0.4; cursor:not-allowed;">
           <span class="export-btn-icon">${f.icon}</span>
           <span class="export-btn-format">.${f.label}</span>
-          <span class="export-btn-desc">Not available</span>
+          <span class="export-btn-desc">${pending ? "Preparing..." : "Not available"}</span>
         </div>`;
         }
         const downloadUrl = `/api/download/${sessionId}/${f.key.toLowerCase()}`;
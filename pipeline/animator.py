@@ -6,9 +6,14 @@ Assembles frames into an animated GIF (usable as sticker).
 """
 
 import os
-import math
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+
+import numpy as np
 from PIL import Image
 
+from pipeline.gif_palette import GIF_TRANSPARENT_INDEX, quantize_frames
+
 
 # Animation presets per emotion style
 ANIMATION_PRESETS = {
@@ -77,80 +82,119 @@ def _get_preset(animation_style: str) -> dict:
     return ANIMATION_PRESETS.get(animation_style.lower(), DEFAULT_PRESET)
 
 
-def _apply_talking_effect(img: Image.Image, intensity: float) -> Image.Image:
+def _mouth_height(img_h: int, intensity: float) -> int:
+    """Height of the stretched bottom half for a given talk intensity."""
+    return int((img_h // 2) * (1 + intensity * 0.05))
+
+
+def _apply_talking_effect(img: Image.Image, new_h: int) -> Image.Image:
     """Simulate talking by slightly scaling the bottom part of the image."""
     w, h = img.size
     bottom_crop = img.crop((0, h // 2, w, h))
-    new_h = int((h // 2) * (1 + intensity * 0.05))
     bottom_scaled = bottom_crop.resize((w, new_h), Image.LANCZOS)
-    result = Image.new("RGBA", (w, h + new_h - h // 2), (0, 0, 0, 0))
-    result.paste(img.crop((0, 0, w, h // 2)), (0, 0))
-    result.paste(
-        bottom_scaled,
-        (0, h // 2),
-        bottom_scaled if bottom_scaled.mode == "RGBA" else None,
+    # Both halves land side by side on an empty canvas, so stacking the pixel
+    # rows is an exact copy — no alpha compositing pass needed
+    stacked = np.concatenate(
+        [
+            np.asarray(img.convert("RGBA"))[: h // 2],
+            np.asarray(bottom_scaled.convert("RGBA")),
+        ]
     )
+    result = Image.fromarray(stacked, "RGBA")
     return result.resize((w, h), Image.LANCZOS)
 
 
-def _make_frame(
-    base_img: Image.Image,
-    frame_idx: int,
-    total_frames: int,
-    preset: dict,
-    canvas_size: int = 512,
-    is_talking: bool = True,
-) -> Image.Image:
-    """Generate a single animation frame with precise sync logic."""
-    t = frame_idx / total_frames  # 0 to 1 normalized
-    angle_rad = 2 * math.pi * t
+def _motion_tables(preset: dict, total_frames: int, is_talking: bool = True):
+    """Precompute per-frame bounce, rotation, scale and talk intensity."""
+    t = np.arange(total_frames) / total_frames  # 0 to 1 normalized
+    angle_rad = 2 * np.pi * t
 
     # Bounce effect (vertical oscillation) - smoother for stickers
-    bounce_y = int(preset["bounce_amplitude"] * math.sin(angle_rad * 2))
+    bounce_y = (preset["bounce_amplitude"] * np.sin(angle_rad * 2)).astype(int)
 
     # Rotation oscillation
-    rotation = preset["rotation_max"] * math.sin(angle_rad)
+    rotation = preset["rotation_max"] * np.sin(angle_rad)
 
     # Scale pulse (breathing effect)
-    scale = 1.0 + preset["scale_pulse"] * math.sin(angle_rad * 2)
+    scale = 1.0 + preset["scale_pulse"] * np.sin(angle_rad * 2)
 
     # Talking intensity (lip-sync sync)
     # We use a combined frequency for erratic but rhythmic mouth movement
-    talk_intensity = 0
+    talk_intensity = np.zeros(total_frames)
     if is_talking:
-        talk_intensity = (math.sin(angle_rad * 12) * 0.5 + 0.5) * (
-            math.sin(angle_rad * 24) * 0.3 + 0.7
+        talk_intensity = (np.sin(angle_rad * 12) * 0.5 + 0.5) * (
+            np.sin(angle_rad * 24) * 0.3 + 0.7
         )
 
-    # Get base dimensions
-    base_w, base_h = base_img.size
+    return bounce_y, rotation, scale, talk_intensity
+
+
+def _affine_coeffs(
+    bounce_y: np.ndarray,
+    rotation: np.ndarray,
+    scale: np.ndarray,
+    src_size: tuple,
+    canvas_size: int = 512,
+) -> np.ndarray:
+    """
+    Inverse affine coefficients (canvas -> source) for every frame at once.
+    Each row scales, rotates and bounces the source around the canvas center.
+    """
+    # PIL expects the inverse mapping, so we go from the bounced canvas
+    # center back through R(-rotation) and 1/scale
+    src_w, src_h = src_size
+    theta = -np.radians(rotation)
+    cos_t = np.cos(theta) / scale
+    sin_t = np.sin(theta) / scale
+    cx = canvas_size / 2
+    cy = canvas_size / 2 + bounce_y
+    return np.stack(
+        [
+            cos_t,
+            sin_t,
+            src_w / 2 - cos_t * cx - sin_t * cy,
+            -sin_t,
+            cos_t,
+            src_h / 2 + sin_t * cx - cos_t * cy,
+        ],
+        axis=1,
+    )
 
-    # Apply scale first
-    new_w = int(base_w * scale)
-    new_h = int(base_h * scale)
-    scaled = base_img.resize((new_w, new_h), Image.LANCZOS)
 
-    # NEW: Apply the talking/mouth effect if intensity > 0
-    if talk_intensity > 0.1:
-        scaled = _apply_talking_effect(scaled, talk_intensity)
+def _make_frame(src: Image.Image, coeffs: tuple, canvas_size: int = 512) -> Image.Image:
+    """Generate a single animation frame in one affine resampling pass."""
+    return src.transform(
+        (canvas_size, canvas_size),
+        Image.AFFINE,
+        coeffs,
+        resample=Image.BILINEAR,
+        fillcolor=(0, 0, 0, 0),
+    )
 
-    # Apply rotation
-    rotated = scaled.rotate(rotation, expand=False, resample=Image.BICUBIC)
 
-    # Create transparent canvas
-    canvas = Image.new("RGBA", (canvas_size, canvas_size), (0, 0, 0, 0))
+def render_frames(base_img: Image.Image, preset: dict, total_frames: int) -> list:
+    """Render every animation frame of a sticker from its base image."""
+    # Per-frame motion values
+    bounce_y, rotation, scale, talk = _motion_tables(preset, total_frames)
+    coeffs = _affine_coeffs(bounce_y, rotation, scale, base_img.size).tolist()
 
-    # Center + bounce
-    paste_x = (canvas_size - rotated.width) // 2
-    paste_y = (canvas_size - rotated.height) // 2 + bounce_y
+    # The mouth effect only depends on the integer stretched height, so the
+    # whole loop needs a handful of distinct variants — render each once
+    @lru_cache(maxsize=64)
+    def _talking_source(new_h: int) -> Image.Image:
+        return _apply_talking_effect(base_img, new_h)
 
-    # Paste with alpha mask
-    if rotated.mode == "RGBA":
-        canvas.paste(rotated, (paste_x, paste_y), rotated)
-    else:
-        canvas.paste(rotated, (paste_x, paste_y))
+    # Generate frames — each frame is independent and PIL's resamplers
+    # release the GIL, so render them concurrently (base_img is read-only)
+    def _render(i: int) -> Image.Image:
+        # Apply the talking/mouth effect on the unscaled source if intensity > 0
+        src = base_img
+        if talk[i] > 0.1:
+            src = _talking_source(_mouth_height(base_img.height, talk[i]))
+        return _make_frame(src, tuple(coeffs[i]), canvas_size=512)
 
-    return canvas
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        return list(pool.map(_render, range(total_frames)))
 
 
 def create_animated_sticker(
@@ -171,7 +215,8 @@ def create_animated_sticker(
         speech_duration_s: Duration of speech (affects frame count)
 
     Returns:
-        dict with gif_path, frame_count, fps, duration_s
+        dict with gif_path, frame_count, fps, duration_s and render_frames,
+        a callable that re-renders the full-quality frames for export
     """
     os.makedirs(output_dir, exist_ok=True)
     preset = _get_preset(animation_style)
@@ -190,27 +235,23 @@ def create_animated_sticker(
     base_img = Image.open(image_path).convert("RGBA")
     base_img = base_img.resize((420, 420), Image.LANCZOS)
 
-    # Generate frames
-    frames = []
-    for i in range(total_frames):
-        frame = _make_frame(base_img, i, total_frames, preset, canvas_size=512)
-        # Convert to RGB for GIF compatibility (P mode)
-        frame_rgb = Image.new("RGBA", frame.size, (255, 255, 255, 0))
-        frame_rgb.paste(frame, mask=frame.split()[3] if frame.mode == "RGBA" else None)
-        frames.append(frame_rgb)
+    frames = render_frames(base_img, preset, total_frames)
 
     # Save animated GIF
     gif_path = os.path.join(output_dir, f"{session_id}_animated.gif")
     frame_duration_ms = int(1000 / preset["fps"])
 
-    frames[0].save(
+    # One shared palette instead of a per-frame quantization in the encoder
+    gif_frames = quantize_frames(frames, transparent=True)
+    gif_frames[0].save(
         gif_path,
         format="GIF",
         save_all=True,
-        append_images=frames[1:],
+        append_images=gif_frames[1:],
         duration=frame_duration_ms,
         loop=0,
         disposal=2,
+        transparency=GIF_TRANSPARENT_INDEX,
     )
 
     duration_s = total_frames / preset["fps"]
@@ -224,5 +265,7 @@ def create_animated_sticker(
         "fps": preset["fps"],
         "duration_s": duration_s,
         "animation_style": animation_style,
-        "frames": frames,  # Keep in memory for MP4 export
+        # Frames are re-rendered on demand for export instead of being kept
+        # alive (~1MB each) through verification and the HTTP response
+        "render_frames": partial(render_frames, base_img, preset, total_frames),
     }
@@ -11,6 +11,10 @@ Architecture:
 
 import os
 import re
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 from PIL import Image
 
@@ -18,98 +22,192 @@ from PIL import Image
 from earcp import EARCP
 
 
+# ─── Component Scoring ───────────────────────────────────────────────────────
+# All four component scores are computed in one pass: the three output files
+# are stat'ed and probed concurrently, then scored together with NumPy.
+
+_IO_POOL = ThreadPoolExecutor(max_workers=5)
+
+# Penalty weights per component (rows: text, image, audio, animation)
+_PENALTY_WEIGHTS = np.array(
+    [
+        [0.1, 0.2, 0.05, 0.0],  # generic subject, short speech, default emotion
+        [0.3, 0.1, 0.2, 0.05],  # < 256px, odd mode, < 5KB, > 5MB
+        [0.5, 0.1, 0.2, 0.0],  # < 2KB, < 10KB, < 0.5s
+        [0.3, 0.1, 0.3, 0.0],  # < 8 frames, > 120 frames, < 128px
+    ]
+)
+
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_PNG_MODES = {0: "L", 2: "RGB", 3: "P", 4: "LA", 6: "RGBA"}  # IHDR color type
+_GIF_FRAME_CAP = 130  # scoring only distinguishes < 8 and > 120 frames
+
+
+def _file_size_kb(path: str):
+    """Return the file size in KB, or None if the file is missing."""
+    if not path:
+        return None
+    try:
+        return os.stat(path).st_size / 1024
+    except OSError:
+        return None
+
+
+def _count_gif_frames(f, cap: int) -> int:
+    """Count GIF image descriptors by walking block headers, up to `cap`."""
+    f.seek(10)
+    flags = f.read(3)[0]
+    if flags & 0x80:  # global color table
+        f.seek(3 << ((flags & 0x07) + 1), os.SEEK_CUR)
+
+    def skip_sub_blocks():
+        while True:
+            size = f.read(1)
+            if not size or size[0] == 0:
+                return
+            f.seek(size[0], os.SEEK_CUR)
+
+    n_frames = 0
+    while n_frames < cap:
+        introducer = f.read(1)
+        if introducer == b"\x2c":  # image descriptor
+            n_frames += 1
+            descriptor = f.read(9)
+            if len(descriptor) < 9:
+                break
+            if descriptor[8] & 0x80:  # local color table
+                f.seek(3 << ((descriptor[8] & 0x07) + 1), os.SEEK_CUR)
+            f.seek(1, os.SEEK_CUR)  # LZW minimum code size
+            skip_sub_blocks()
+        elif introducer == b"\x21":  # extension
+            f.seek(1, os.SEEK_CUR)
+            skip_sub_blocks()
+        else:  # trailer or truncated file
+            break
+    return n_frames
+
+
+def _probe_image(path: str, count_frames: bool = False):
+    """
+    Return (width, height, mode, n_frames), or None if unreadable.
+    PNG and GIF are read from their headers without invoking a decoder;
+    other formats (e.g. uploaded JPEG avatars) go through PIL.
+    """
+    if not path:
+        return None
+    try:
+        with open(path, "rb") as f:
+            header = f.read(26)
+            if header[:8] == _PNG_SIGNATURE and header[12:16] == b"IHDR":
+                w, h = struct.unpack(">II", header[16:24])
+                return w, h, _PNG_MODES.get(header[25], ""), 1
+            if header[:6] in (b"GIF87a", b"GIF89a"):
+                w, h = struct.unpack("<HH", header[6:10])
+                n_frames = _count_gif_frames(f, _GIF_FRAME_CAP) if count_frames else 1
+                return w, h, "P", n_frames
+        with Image.open(path) as img:
+            n_frames = getattr(img, "n_frames", 1) if count_frames else 1
+            return img.width, img.height, img.mode, n_frames
+    except Exception:
+        return None
+
+
+def _score_all(context: dict) -> np.ndarray:
+    """Score text, image, audio and animation at once. Returns shape (4, 1)."""
+    size_futures = [
+        _IO_POOL.submit(_file_size_kb, context.get(key, ""))
+        for key in ("image_path", "audio_path", "gif_path")
+    ]
+    image_future = _IO_POOL.submit(_probe_image, context.get("image_path", ""))
+    gif_future = _IO_POOL.submit(_probe_image, context.get("gif_path", ""), True)
+
+    image_kb, audio_kb, gif_kb = (f.result() for f in size_futures)
+    image_info = image_future.result()
+    gif_info = gif_future.result()
+
+    subject = context.get("subject", "")
+    speech = context.get("speech_text", "")
+    emotion = context.get("emotion", "")
+    duration = context.get("audio_duration_s", 0.0)
+    img_w, img_h, img_mode, _ = image_info or (0, 0, "", 0)
+    gif_w, gif_h, _, n_frames = gif_info or (0, 0, "", 0)
+    img_kb = image_kb or 0.0
+    aud_kb = audio_kb or 0.0
+
+    flags = np.array(
+        [
+            [
+                not subject or subject == "cute cartoon character",
+                not speech or len(speech.strip()) < 3,
+                not emotion or emotion == "happy",
+                False,
+            ],
+            [
+                img_w < 256 or img_h < 256,
+                img_mode not in ("RGBA", "RGB"),
+                img_kb < 5,
+                img_kb > 5000,
+            ],
+            [aud_kb < 2, 2 <= aud_kb < 10, duration < 0.5, False],
+            [n_frames < 8, n_frames > 120, gif_w < 128 or gif_h < 128, False],
+        ]
+    )
+    exists = np.array(
+        [True, image_kb is not None, audio_kb is not None, gif_kb is not None]
+    )
+    readable = np.array([True, image_info is not None, True, gif_info is not None])
+
+    raw = 1.0 - (flags * _PENALTY_WEIGHTS).sum(axis=1)
+    scores = np.where(exists, np.where(readable, raw, 0.3), 0.0)
+    return np.maximum(scores, 0.0).reshape(4, 1)
+
+
+def _expert_scores(context: dict) -> np.ndarray:
+    """Compute all component scores once per context and cache them in it."""
+    if "_scores" not in context:
+        context["_scores"] = _score_all(context)
+    return context["_scores"]
+
+
 # ─── Virtual Expert Wrappers ─────────────────────────────────────────────────
 # Each expert implements the EARCP-required .predict(x) interface.
-# They receive a shared "context" dict and return a quality score in [0, 1].
+# They receive a shared "context" dict and return a quality score in [0, 1],
+# read from the batched scores above.
 
 
 class TextQualityExpert:
     """EARCP Expert #1: judges text/NLP component quality."""
 
     def predict(self, context: dict) -> np.ndarray:
-        subject = context.get("subject", "")
-        speech = context.get("speech_text", "")
-        emotion = context.get("emotion", "")
-
-        score = 1.0
-        if not subject or subject == "cute cartoon character":
-            score -= 0.1
-        if not speech or len(speech.strip()) < 3:
-            score -= 0.2
-        if not emotion or emotion == "happy":
-            score -= 0.05
-        return np.array([max(0.0, score)])
+        return _expert_scores(context)[0]
 
 
 class ImageQualityExpert:
     """EARCP Expert #2: judges generated image quality."""
 
     def predict(self, context: dict) -> np.ndarray:
-        path = context.get("image_path", "")
-        score = 1.0
-        if not path or not os.path.exists(path):
-            return np.array([0.0])
-        try:
-            img = Image.open(path)
-            w, h = img.size
-            if w < 256 or h < 256:
-                score -= 0.3
-            if img.mode not in ("RGBA", "RGB"):
-                score -= 0.1
-            fsize = os.path.getsize(path) / 1024
-            if fsize < 5:
-                score -= 0.2
-            if fsize > 5000:
-                score -= 0.05
-        except Exception:
-            score = 0.3
-        return np.array([max(0.0, score)])
+        return _expert_scores(context)[1]
 
 
 class AudioQualityExpert:
     """EARCP Expert #3: judges TTS audio quality."""
 
     def predict(self, context: dict) -> np.ndarray:
-        path = context.get("audio_path", "")
-        duration = context.get("audio_duration_s", 0.0)
-        score = 1.0
-        if not path or not os.path.exists(path):
-            return np.array([0.0])
-        fsize = os.path.getsize(path) / 1024
-        if fsize < 2:
-            score -= 0.5
-        elif fsize < 10:
-            score -= 0.1
-        if duration < 0.5:
-            score -= 0.2
-        return np.array([max(0.0, score)])
+        return _expert_scores(context)[2]
 
 
 class AnimationQualityExpert:
     """EARCP Expert #4: judges animated sticker quality."""
 
     def predict(self, context: dict) -> np.ndarray:
-        path = context.get("gif_path", "")
-        score = 1.0
-        if not path or not os.path.exists(path):
-            return np.array([0.0])
-        try:
-            gif = Image.open(path)
-            n_frames = getattr(gif, "n_frames", 1)
-            if n_frames < 8:
-                score -= 0.3
-            if n_frames > 120:
-                score -= 0.1
-            w, h = gif.size
-            if w < 128 or h < 128:
-                score -= 0.3
-        except Exception:
-            score = 0.3
-        return np.array([max(0.0, score)])
+        return _expert_scores(context)[3]
 
 
 # ─── Coherence helpers ────────────────────────────────────────────────────────
 
+_PUNCT_RE = re.compile(r"[^\w\s]")
+
 
 def _text_image_coherence(context: dict) -> float:
     prompt = context.get("image_prompt", "").lower()
@@ -127,17 +225,14 @@ def _text_image_coherence(context: dict) -> float:
 
 
 def _text_audio_coherence(context: dict) -> float:
-    orig = re.sub(r"[^\w\s]", "", context.get("original_phrase", "").lower())
-    speech = re.sub(r"[^\w\s]", "", context.get("speech_text", "").lower())
-    orig_w = set(orig.split())
-    speech_w = set(speech.split())
+    orig_l = context.get("original_phrase", "").lower()
+    speech_l = context.get("speech_text", "").lower()
+    orig_w = frozenset(_PUNCT_RE.sub("", orig_l).split())
+    speech_w = frozenset(_PUNCT_RE.sub("", speech_l).split())
     if not orig_w:
         return 0.5
     overlap = len(orig_w & speech_w) / len(orig_w)
-    if (
-        context.get("speech_text", "").lower()
-        in context.get("original_phrase", "").lower()
-    ):
+    if speech_l in orig_l:
         overlap = max(overlap, 0.85)
     return min(1.0, overlap)
 
@@ -166,6 +261,40 @@ def _build_auto_notes(context: dict, component_scores: dict) -> list:
     return notes
 
 
+# ─── Ensemble ─────────────────────────────────────────────────────────────────
+# Experts are stateless, so one set is shared. The ensemble keeps EMA state
+# between predict/update calls, so each worker thread owns one instance and
+# resets it before every verification.
+
+_EXPERTS = [
+    TextQualityExpert(),
+    ImageQualityExpert(),
+    AudioQualityExpert(),
+    AnimationQualityExpert(),
+]
+
+_local = threading.local()
+
+
+def _get_ensemble() -> EARCP:
+    """Return this thread's EARCP ensemble in its initial state."""
+    ensemble = getattr(_local, "ensemble", None)
+    if ensemble is None:
+        ensemble = EARCP(
+            experts=_EXPERTS,
+            beta=0.65,  # 65% performance weight, 35% coherence
+            eta_s=5.0,  # softmax sensitivity
+            w_min=0.05,  # minimum floor per expert
+            alpha_P=0.9,  # performance EMA
+            alpha_C=0.85,  # coherence EMA
+            track_diagnostics=True,
+        )
+        _local.ensemble = ensemble
+    else:
+        ensemble.reset()
+    return ensemble
+
+
 # ─── Main Entry Point ─────────────────────────────────────────────────────────
 
 
@@ -206,23 +335,8 @@ def verify_sticker(
         "animation_duration_s": animation_result.get("duration_s", 2.0),
     }
 
-    # ── 1. Instantiate EARCP with 4 Virtual Experts ───────────────────────────
-    experts = [
-        TextQualityExpert(),
-        ImageQualityExpert(),
-        AudioQualityExpert(),
-        AnimationQualityExpert(),
-    ]
-
-    ensemble = EARCP(
-        experts=experts,
-        beta=0.65,  # 65% performance weight, 35% coherence
-        eta_s=5.0,  # softmax sensitivity
-        w_min=0.05,  # minimum floor per expert
-        alpha_P=0.9,  # performance EMA
-        alpha_C=0.85,  # coherence EMA
-        track_diagnostics=True,
-    )
+    # ── 1. Get this thread's EARCP ensemble (4 Virtual Experts) ──────────────
+    ensemble = _get_ensemble()
 
     # ── 2. Get predictions from all experts ───────────────────────────────────
     _, expert_preds = ensemble.predict(context)
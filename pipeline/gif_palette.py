@@ -0,0 +1,51 @@
+"""
+ChattyStickers — GIF Palette
+Shared-palette quantization used by every GIF the pipeline writes.
+"""
+
+import numpy as np
+from PIL import Image
+
+# Palette slot reserved for transparent pixels when a GIF keeps its alpha
+GIF_TRANSPARENT_INDEX = 255
+
+
+def _flatten(frame) -> Image.Image:
+    """Frame as RGB on white; accepts PIL images or (H, W, 3) uint8 arrays."""
+    if isinstance(frame, np.ndarray):
+        return Image.fromarray(frame)
+    if frame.mode == "RGB":
+        return frame
+    if frame.mode != "RGBA":
+        return frame.convert("RGB")
+    bg = Image.new("RGB", frame.size, (255, 255, 255))
+    bg.paste(frame, mask=frame.getchannel("A"))
+    return bg
+
+
+def quantize_frames(frames, transparent: bool = False) -> list:
+    """
+    Quantize frames to one shared palette for GIF encoding.
+
+    Frames share nearly all their colors, so the palette is built once from
+    the middle frame and every frame is mapped onto it instead of being
+    re-quantized (which also stops the palette shimmering between frames).
+    With `transparent`, GIF_TRANSPARENT_INDEX is left out of the palette and
+    fully transparent pixels of RGBA frames map to it.
+    """
+    colors = 255 if transparent else 256
+    master = _flatten(frames[len(frames) // 2]).quantize(
+        colors=colors, method=Image.MEDIANCUT
+    )
+    palette = master.getpalette()
+
+    quantized = []
+    for frame in frames:
+        p_frame = _flatten(frame).quantize(palette=master, dither=Image.NONE)
+        if transparent and isinstance(frame, Image.Image) and frame.mode == "RGBA":
+            indices = np.array(p_frame)
+            indices[np.asarray(frame.getchannel("A")) == 0] = GIF_TRANSPARENT_INDEX
+            p_frame = Image.fromarray(indices, "P")
+            p_frame.putpalette(palette)
+        quantized.append(p_frame)
+    return quantized
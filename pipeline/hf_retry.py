@@ -0,0 +1,82 @@
+"""
+ChattyStickers — HF Retry Helpers
+Shared retry policy for calls to the HuggingFace Inference API.
+"""
+
+import random
+import threading
+import time
+
+# Per-endpoint circuit breaker: after BREAKER_THRESHOLD failures within
+# BREAKER_WINDOW_S the endpoint is skipped for BREAKER_COOLOFF_S, then a
+# single half-open probe decides whether it closes again
+BREAKER_THRESHOLD = 5
+BREAKER_WINDOW_S = 60
+BREAKER_COOLOFF_S = 30
+
+# Capped exponential backoff with full jitter for 503 "model loading" retries
+RETRY_BASE_S = 2
+RETRY_CAP_S = 15
+
+
+def backoff_delay(attempt: int, estimated_time: float = None) -> float:
+    """
+    Seconds to wait before retry number `attempt` (0-based).
+
+    Full jitter spreads workers that hit a cold model together so they do
+    not wake in lockstep. The server's `estimated_time` is honored as a
+    floor on the first retry only.
+    """
+    wait = random.uniform(0, min(RETRY_CAP_S, RETRY_BASE_S * 2**attempt))
+    if attempt == 0 and estimated_time:
+        wait = max(wait, min(float(estimated_time), RETRY_CAP_S))
+    return wait
+
+
+# ─── Circuit breaker ───
+
+# endpoint -> {"failures": [timestamps], "opened_at": float, "state": str}
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker_allows(endpoint: str) -> bool:
+    """Whether a request to `endpoint` may go out right now."""
+    with _breakers_lock:
+        breaker = _breakers.get(endpoint)
+        if breaker is None or breaker["state"] == "closed":
+            return True
+        now = time.monotonic()
+        if now - breaker["opened_at"] >= BREAKER_COOLOFF_S:
+            # Let exactly one probe through; others keep skipping until it
+            # lands. A probe that never reports back (e.g. abandoned because
+            # another model answered) is replaced after another cool-off.
+            breaker["state"] = "half_open"
+            breaker["opened_at"] = now
+            return True
+        return False
+
+
+def record_success(endpoint: str):
+    with _breakers_lock:
+        _breakers.pop(endpoint, None)
+
+
+def record_failure(endpoint: str):
+    now = time.monotonic()
+    with _breakers_lock:
+        breaker = _breakers.setdefault(
+            endpoint, {"failures": [], "opened_at": 0.0, "state": "closed"}
+        )
+        if breaker["state"] == "half_open":
+            breaker["state"] = "open"
+            breaker["opened_at"] = now
+            return
+        breaker["failures"] = [
+            t for t in breaker["failures"] if now - t < BREAKER_WINDOW_S
+        ] + [now]
+        if len(breaker["failures"]) >= BREAKER_THRESHOLD:
+            breaker["state"] = "open"
+            breaker["opened_at"] = now
+            breaker["failures"] = []
+            print(f"[HF] Circuit open for {endpoint} ({BREAKER_COOLOFF_S}s)")
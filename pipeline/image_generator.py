@@ -8,14 +8,33 @@ Falls back to a Pillow-generated placeholder if API fails.
 import os
 import io
 import time
+import shutil
+import threading
+import numpy as np
 import requests
-from PIL import Image, ImageDraw, ImageFont
+from requests.adapters import HTTPAdapter
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from functools import lru_cache
+from PIL import Image, ImageChops, ImageDraw, ImageFont
 from dotenv import load_dotenv
 
+from pipeline.hf_retry import (
+    backoff_delay,
+    breaker_allows,
+    record_failure,
+    record_success,
+)
+
 load_dotenv()
 
 HF_TOKEN = os.getenv("HF_TOKEN")
 
+# One keep-alive session for every model and retry, so fallbacks and 503
+# retries reuse the TLS connection to the HF router instead of reconnecting
+_SESSION = requests.Session()
+_SESSION.headers.update({"Authorization": f"Bearer {HF_TOKEN}"})
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
 # Primary: FLUX / SDXL — high quality models on HF Router
 HF_IMAGE_MODELS = [
     "black-forest-labs/FLUX.1-schnell",
@@ -25,66 +44,160 @@ HF_IMAGE_MODELS = [
 
 HF_API_BASE = "https://router.huggingface.co/hf-inference/models"
 
+# Wall-clock budget for 503 retries across all models, so a cold model
+# cannot hold the request past the caller's patience
+HF_RETRY_BUDGET_S = 60
+
+# Start the next model in parallel if the current one has not answered
+# within this many seconds; the first image back wins
+HEDGE_DELAY_S = 3
+
+# Diffusion settings per model. FLUX.1-schnell is timestep-distilled: it is
+# built for ~4 steps without classifier-free guidance, so the SD defaults
+# would spend ~6x the denoising steps for no visible gain.
+DEFAULT_INFERENCE_PARAMS = {"num_inference_steps": 25, "guidance_scale": 7.5}
+HF_MODEL_PARAMS = {
+    "black-forest-labs/FLUX.1-schnell": {
+        "num_inference_steps": 4,
+        "guidance_scale": 0.0,
+    },
+}
+
+# Prompts currently being generated -> Future resolving to the leader's PNG.
+# Concurrent requests for the same prompt wait on it instead of spending
+# another HF inference call.
+_inflight = {}
+_inflight_lock = threading.Lock()
 
-def generate_image_from_hf(prompt: str, output_path: str) -> str:
+
+def _try_model(model: str, prompt: str, deadline: float, stop: threading.Event):
     """
-    Attempt to generate an image via HuggingFace Inference API.
-    Tries multiple models. Returns output path on success.
+    Run one model's attempts, retrying while it loads (503).
+    Returns the finished sticker image, or None if this model gave up or
+    `stop` was set because another model already answered.
     """
-    headers = {"Authorization": f"Bearer {HF_TOKEN}"}
+    api_url = f"{HF_API_BASE}/{model}"
     payload = {
         "inputs": prompt,
         "parameters": {
-            "num_inference_steps": 25,
-            "guidance_scale": 7.5,
+            **DEFAULT_INFERENCE_PARAMS,
+            **HF_MODEL_PARAMS.get(model, {}),
             "width": 512,
             "height": 512,
         },
     }
+    if not breaker_allows(model):
+        print(f"[ImageGen] Circuit open for {model}. Skipping.")
+        return None
+    print(f"[ImageGen] Trying model: {model}")
 
-    for model in HF_IMAGE_MODELS:
-        api_url = f"{HF_API_BASE}/{model}"
-        print(f"[ImageGen] Trying model: {model}")
-
-        max_retries = 4
-        for attempt in range(max_retries):
+    # 503 means the model is still loading, not that it is broken: wait it
+    # out, and only count against the breaker once the wait is abandoned
+    max_retries = 4
+    for attempt in range(max_retries):
+        if stop.is_set():
+            return None
+        try:
+            response = _SESSION.post(api_url, json=payload, timeout=60)
+            if response.status_code == 200:
+                img = Image.open(io.BytesIO(response.content))
+                img = img.convert("RGBA")
+                img = img.resize((512, 512), Image.LANCZOS)
+                img = _apply_rounded_corners(img, radius=60)
+                record_success(model)
+                return img
+            elif response.status_code == 503:
+                if attempt == max_retries - 1:
+                    # No retry left to wait for — let the next model start now
+                    record_failure(model)
+                    print(f"[ImageGen] {model} still loading. Skipping.")
+                    return None
+                estimated_time = response.json().get("estimated_time", 10)
+                wait_time = backoff_delay(attempt, estimated_time)
+                if time.monotonic() + wait_time > deadline:
+                    record_failure(model)
+                    print(f"[ImageGen] Retry budget spent. Skipping {model}.")
+                    return None
+                print(
+                    f"[ImageGen] Model {model} is loading. Waiting {wait_time:.1f}s (attempt {attempt + 1}/{max_retries})..."
+                )
+            else:
+                record_failure(model)
+                print(
+                    f"[ImageGen] {model} returned {response.status_code}: {response.text[:200]}"
+                )
+                return None  # Give up on this model, try next
+        except Exception as e:
+            record_failure(model)
             try:
-                response = requests.post(
-                    api_url, headers=headers, json=payload, timeout=60
+                print(f"[ImageGen] Error with {model}: {e}")
+            except UnicodeEncodeError:
+                print(
+                    f"[ImageGen] Error with {model}: [Exception contains special characters]"
                 )
-                if response.status_code == 200:
-                    img = Image.open(io.BytesIO(response.content))
-                    img = img.convert("RGBA")
-                    img = img.resize((512, 512), Image.LANCZOS)
-                    img = _apply_rounded_corners(img, radius=60)
+            return None  # Give up on this model, try next
+        # Wakes early if another model wins meanwhile
+        stop.wait(wait_time)
+    return None
+
+
+def generate_image_from_hf(prompt: str, output_path: str) -> tuple:
+    """
+    Attempt to generate an image via HuggingFace Inference API.
+    Tries multiple models. Returns (output path, placeholder), where
+    placeholder is True when every model failed and the stand-in was drawn.
+
+    Models are hedged: the next one starts as soon as the current one
+    fails, or after HEDGE_DELAY_S without an answer, and the first image
+    back wins.
+    """
+    if not HF_TOKEN:
+        # Every model would just answer 401 — skip the round-trips
+        print("[ImageGen] HF_TOKEN not set. Generating placeholder.")
+        return generate_placeholder_image(prompt, output_path), True
+
+    deadline = time.monotonic() + HF_RETRY_BUDGET_S
+    stop = threading.Event()
+    models = iter(HF_IMAGE_MODELS)
+    pending = set()
+    model_of = {}  # future -> model it is trying
+    pool = ThreadPoolExecutor(max_workers=len(HF_IMAGE_MODELS))
+
+    def _launch_next() -> bool:
+        model = next(models, None)
+        if model is None:
+            return False
+        future = pool.submit(_try_model, model, prompt, deadline, stop)
+        model_of[future] = model
+        pending.add(future)
+        return True
+
+    try:
+        _launch_next()
+        while pending:
+            done, pending = wait(
+                pending, timeout=HEDGE_DELAY_S, return_when=FIRST_COMPLETED
+            )
+            if not done:
+                if _launch_next():
+                    print(f"[ImageGen] No answer after {HEDGE_DELAY_S}s, hedging.")
+                continue
+            for future in done:
+                img = future.result()
+                if img is not None:
                     img.save(output_path, "PNG")
+                    model = model_of[future]
                     print(f"[ImageGen] Success with {model} -> {output_path}")
-                    return output_path
-                elif response.status_code == 503:
-                    estimated_time = response.json().get("estimated_time", 10)
-                    wait_time = min(estimated_time, 15)
-                    print(
-                        f"[ImageGen] Model {model} is loading. Waiting {wait_time}s (attempt {attempt + 1}/{max_retries})..."
-                    )
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    print(
-                        f"[ImageGen] {model} returned {response.status_code}: {response.text[:200]}"
-                    )
-                    break  # Break retry loop, try next model
-            except Exception as e:
-                try:
-                    print(f"[ImageGen] Error with {model}: {e}")
-                except UnicodeEncodeError:
-                    print(
-                        f"[ImageGen] Error with {model}: [Exception contains special characters]"
-                    )
-                break  # Break retry loop, try next model
+                    return output_path, False
+                _launch_next()
+    finally:
+        # Losers stop retrying; in-flight posts finish in the background
+        stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
 
     # All models failed → generate beautiful placeholder
     print("[ImageGen] All HF models failed. Generating placeholder.")
-    return generate_placeholder_image(prompt, output_path)
+    return generate_placeholder_image(prompt, output_path), True
 
 
 def _apply_rounded_corners(img: Image.Image, radius: int) -> Image.Image:
@@ -92,9 +205,39 @@ def _apply_rounded_corners(img: Image.Image, radius: int) -> Image.Image:
     mask = Image.new("L", img.size, 0)
     draw = ImageDraw.Draw(mask)
     draw.rounded_rectangle([(0, 0), img.size], radius=radius, fill=255)
-    result = Image.new("RGBA", img.size, (0, 0, 0, 0))
-    result.paste(img, mask=mask)
-    return result
+    # Only the alpha channel changes, so edit it in place instead of
+    # compositing the whole image onto a fresh canvas
+    img.putalpha(ImageChops.multiply(img.getchannel("A"), mask))
+    return img
+
+
+@lru_cache(maxsize=4)
+def _gradient_rows(size: int) -> np.ndarray:
+    """
+    Placeholder gradient as a (size, 4) uint8 RGBA table, one color per row.
+    Red starts above 255 at the top and saturates, as PIL's fill did.
+    """
+    y = np.arange(size)[:, None] / size
+    rows = np.hstack(
+        [
+            255 * (1 - y) * 0.8 + 100,
+            180 * y + 60,
+            220 * y * 0.7 + 80,
+            np.full_like(y, 255),
+        ]
+    )
+    rows = np.minimum(rows.astype(int), 255).astype(np.uint8)
+    rows.flags.writeable = False
+    return rows
+
+
+@lru_cache(maxsize=8)
+def _get_font(name: str, size: int):
+    """Load a TrueType font once per (name, size), falling back to PIL's default."""
+    try:
+        return ImageFont.truetype(name, size)
+    except Exception:
+        return ImageFont.load_default()
 
 
 def generate_placeholder_image(prompt: str, output_path: str) -> str:
@@ -103,15 +246,12 @@ def generate_placeholder_image(prompt: str, output_path: str) -> str:
     Creates a colorful gradient sticker with emoji and text.
     """
     size = 512
-    img = Image.new("RGBA", (size, size), (0, 0, 0, 0))
-    draw = ImageDraw.Draw(img)
 
-    # Gradient background
-    for y in range(size):
-        r = int(255 * (1 - y / size) * 0.8 + 100)
-        g = int(180 * (y / size) + 60)
-        b = int(220 * (y / size) * 0.7 + 80)
-        draw.line([(0, y), (size, y)], fill=(r, g, b, 255))
+    # Gradient background — fill every row from the cached color table
+    gradient = np.empty((size, size, 4), dtype=np.uint8)
+    gradient[:] = _gradient_rows(size)[:, None, :]
+    img = Image.fromarray(gradient, "RGBA")
+    draw = ImageDraw.Draw(img)
 
     # Rounded corners
     mask = Image.new("L", (size, size), 0)
@@ -144,10 +284,7 @@ def generate_placeholder_image(prompt: str, output_path: str) -> str:
         [20, size - 90, size - 20, size - 20], radius=20, fill=(0, 0, 0, 140)
     )
 
-    try:
-        font = ImageFont.truetype("arial.ttf", 22)
-    except Exception:
-        font = ImageFont.load_default()
+    font = _get_font("arial.ttf", 22)
 
     draw.text(
         (size // 2, size - 55), label, fill=(255, 255, 255, 255), anchor="mm", font=font
@@ -158,7 +295,9 @@ def generate_placeholder_image(prompt: str, output_path: str) -> str:
     return output_path
 
 
-def generate_sticker_image(image_prompt: str, session_id: str, output_dir: str) -> str:
+def generate_sticker_image(
+    image_prompt: str, session_id: str, output_dir: str
+) -> tuple:
     """
     Main entry point for image generation.
 
@@ -168,8 +307,35 @@ def generate_sticker_image(image_prompt: str, session_id: str, output_dir: str)
         output_dir: Directory to save output file
 
     Returns:
-        Path to generated PNG image
+        (path to generated PNG image, whether it is the placeholder)
     """
     os.makedirs(output_dir, exist_ok=True)
     output_path = os.path.join(output_dir, f"{session_id}_sticker.png")
-    return generate_image_from_hf(image_prompt, output_path)
+
+    with _inflight_lock:
+        pending = _inflight.get(image_prompt)
+        if pending is None:
+            pending = _inflight[image_prompt] = Future()
+            leader = True
+        else:
+            leader = False
+
+    if not leader:
+        print("[ImageGen] Same prompt already in flight. Sharing its result.")
+        try:
+            src_path, placeholder = pending.result()
+            shutil.copyfile(src_path, output_path)
+            return output_path, placeholder
+        except Exception:
+            return generate_image_from_hf(image_prompt, output_path)
+
+    try:
+        result = generate_image_from_hf(image_prompt, output_path)
+        pending.set_result(result)
+        return result
+    except BaseException as e:
+        pending.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight[image_prompt]
@@ -15,29 +15,232 @@ Output hierarchy:
 import os
 import shutil
 import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 import numpy as np
 import imageio
 from PIL import Image
 
+from pipeline.gif_palette import quantize_frames
+
+
+# Render node used for VAAPI hardware encoding when the GPU exposes one
+VAAPI_DEVICE = "/dev/dri/renderD128"
+
+# libvpx settings: explicit CRF 32 (its default) in constant-quality mode,
+# at a speed preset that keeps quality while using row multithreading
+LIBVPX_VP9_PARAMS = ["-crf", "32", "-b:v", "0"]
+LIBVPX_VP9_SPEED = ["-deadline", "good", "-cpu-used", "4", "-row-mt", "1"]
+
 
 # ─── Helpers ──────────────────────────────────────────────────────────────────
 
 
-def _frames_to_webm_silent(frames: list, fps: int, dest: str) -> bool:
-    """Write PIL frames to a silent WebM file. Returns True on success."""
-    if not frames:
-        return False
+def _to_rgb(frame: Image.Image) -> Image.Image:
+    """Flatten a frame onto a white background for formats without alpha."""
+    if frame.mode == "RGB":
+        return frame
+    if frame.mode != "RGBA":
+        return frame.convert("RGB")
+    bg = Image.new("RGB", frame.size, (255, 255, 255))
+    bg.paste(frame, mask=frame.getchannel("A"))
+    return bg
+
+
+@lru_cache(maxsize=1)
+def _ffmpeg_exe() -> str:
+    """ffmpeg from PATH, else the binary bundled with imageio-ffmpeg."""
+    exe = shutil.which("ffmpeg")
+    if exe:
+        return exe
+    import imageio_ffmpeg
+
+    return imageio_ffmpeg.get_ffmpeg_exe()
+
+
+@lru_cache(maxsize=1)
+def _vp9_writer_configs() -> tuple:
+    """
+    VP9 writer settings to try in order, probed once per process.
+    The VAAPI hardware encoder goes first when both ffmpeg and the machine
+    support it; libvpx is always kept as the last resort.
+    """
+    software = {
+        "codec": "libvpx-vp9",
+        "output_params": LIBVPX_VP9_PARAMS + LIBVPX_VP9_SPEED,
+    }
     try:
-        # Use VP9 for high quality and transparency support (though currently RGB)
-        writer = imageio.get_writer(
-            dest, fps=fps, codec="libvpx-vp9", quality=8, macro_block_size=None
+        encoders = subprocess.run(
+            [_ffmpeg_exe(), "-hide_banner", "-encoders"],
+            capture_output=True,
+            timeout=10,
+        ).stdout.decode(errors="ignore")
+    except Exception:
+        return (software,)
+
+    if "vp9_vaapi" not in encoders or not os.path.exists(VAAPI_DEVICE):
+        return (software,)
+
+    vaapi = {
+        "codec": "vp9_vaapi",
+        "pixelformat": "vaapi",
+        "input_params": ["-vaapi_device", VAAPI_DEVICE],
+        "output_params": ["-vf", "format=nv12,hwupload"],
+    }
+    # Listing the encoder doesn't mean the GPU can encode VP9 (or that we may
+    # open the render node), so encode one test frame before trusting it
+    test_cmd = [
+        _ffmpeg_exe(),
+        "-loglevel",
+        "error",
+        *vaapi["input_params"],
+        "-f",
+        "lavfi",
+        "-i",
+        "color=c=black:s=64x64:d=0.1",
+        "-frames:v",
+        "1",
+        *vaapi["output_params"],
+        "-c:v",
+        "vp9_vaapi",
+        "-f",
+        "null",
+        "-",
+    ]
+    try:
+        returncode, err_tail = _run_ffmpeg(test_cmd, timeout=15)
+    except Exception as e:
+        returncode, err_tail = -1, str(e)
+    if returncode != 0:
+        print(f"[Exporter] VAAPI VP9 test encode failed, using libvpx: {err_tail}")
+        return (software,)
+
+    print("[Exporter] Using VAAPI hardware VP9 encoder")
+    return (vaapi, software)
+
+
+def _run_ffmpeg(cmd: list, timeout: float = 90) -> tuple:
+    """
+    Run an ffmpeg command without buffering its stdout.
+    Returns (returncode, last 300 chars of stderr); only errors are logged.
+    """
+    proc = subprocess.Popen(
+        cmd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    try:
+        _, err = proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        raise
+    return proc.returncode, err[-300:].decode(errors="replace")
+
+
+def _rgb_buffer(frames: list):
+    """Flatten PIL frames into one preallocated (N, H, W, 3) uint8 buffer."""
+    images = [f for f in frames if isinstance(f, Image.Image)]
+    if not images:
+        return None
+    w, h = images[0].size
+    buf = np.empty((len(images), h, w, 3), dtype=np.uint8)
+    for i, frame in enumerate(images):
+        buf[i] = np.asarray(_to_rgb(frame))
+    return buf
+
+
+def _encode_webm_with_audio(
+    buf: np.ndarray, audio_path: str, fps: int, dest: str
+) -> bool:
+    """
+    Encode frames and voice into the final WebM in a single ffmpeg pass.
+    The (N, H, W, 3) RGB buffer is piped through stdin, so no intermediate
+    video is written to disk or decoded again. Returns True on success.
+    """
+    n, h, w, _ = buf.shape
+
+    for config in _vp9_writer_configs():
+        cmd = [
+            _ffmpeg_exe(),
+            "-y",
+            "-loglevel",
+            "error",
+            *config.get("input_params", []),
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "rgb24",
+            "-s",
+            f"{w}x{h}",
+            "-r",
+            str(fps),
+            "-i",
+            "-",
+            "-stream_loop",
+            "-1",  # loop audio if needed
+            "-i",
+            audio_path,
+            "-c:v",
+            config["codec"],
+            "-pix_fmt",
+            config.get("pixelformat", "yuv420p"),
+            *config["output_params"],
+            "-c:a",
+            "libopus",
+            "-b:a",
+            "64k",
+            "-shortest",
+            dest,
+        ]
+        try:
+            proc = subprocess.Popen(
+                cmd,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+            )
+            # Feed the frame buffer in place (no tobytes() copy); communicate
+            # does the writing, so a stalled ffmpeg is covered by the timeout
+            _, err = proc.communicate(input=buf.data.cast("B"), timeout=90)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            print(f"[Exporter] {config['codec']} single-pass encode timed out")
+            continue
+        except Exception as e:
+            print(f"[Exporter] {config['codec']} single-pass encode error: {e}")
+            continue
+        if proc.returncode == 0 and os.path.getsize(dest) > 0:
+            return True
+        print(
+            f"[Exporter] {config['codec']} single-pass encode failed: "
+            f"{err[-300:].decode(errors='replace')}"
         )
-        for frame in frames:
-            if isinstance(frame, Image.Image):
-                writer.append_data(np.array(frame.convert("RGB")))
-        writer.close()
-        return os.path.exists(dest) and os.path.getsize(dest) > 0
+    return False
+
+
+def _frames_to_webm_silent(buf: np.ndarray, fps: int, dest: str) -> bool:
+    """Write an (N, H, W, 3) RGB buffer to a silent WebM file. True on success."""
+    try:
+        # Use VP9 for high quality and transparency support (though currently RGB)
+        for config in _vp9_writer_configs():
+            try:
+                writer = imageio.get_writer(
+                    dest, fps=fps, quality=8, macro_block_size=None, **config
+                )
+                for rgb in buf:
+                    writer.append_data(rgb)
+                writer.close()
+            except Exception as e:
+                print(f"[Exporter] {config['codec']} failed ({e}), trying next")
+                continue
+            if os.path.exists(dest) and os.path.getsize(dest) > 0:
+                return True
+        return False
     except Exception as e:
         try:
             print(f"[Exporter] Silent WebM write error: {e}")
@@ -60,6 +263,8 @@ def _merge_audio_ffmpeg(
         cmd = [
             "ffmpeg",
             "-y",
+            "-loglevel",
+            "error",
             "-i",
             video_path,
             "-stream_loop",
@@ -77,12 +282,12 @@ def _merge_audio_ffmpeg(
             "+faststart",
             dest,
         ]
-        result = subprocess.run(cmd, capture_output=True, timeout=90)
-        if result.returncode == 0 and os.path.getsize(dest) > 0:
+        returncode, err_tail = _run_ffmpeg(cmd, timeout=90)
+        if returncode == 0 and os.path.getsize(dest) > 0:
             return True
         else:
             try:
-                print(f"[Exporter] ffmpeg merge error: {result.stderr.decode()[:300]}")
+                print(f"[Exporter] ffmpeg merge error: {err_tail}")
             except UnicodeEncodeError:
                 print(
                     f"[Exporter] ffmpeg merge error: [Error contains special characters]"
@@ -105,6 +310,8 @@ def _merge_audio_imageio_ffmpeg(video_path: str, audio_path: str, dest: str) ->
         cmd = [
             ffmpeg_bin,
             "-y",
+            "-loglevel",
+            "error",
             "-i",
             video_path,
             "-stream_loop",
@@ -122,8 +329,8 @@ def _merge_audio_imageio_ffmpeg(video_path: str, audio_path: str, dest: str) ->
             "+faststart",
             dest,
         ]
-        result = subprocess.run(cmd, capture_output=True, timeout=90)
-        return result.returncode == 0 and os.path.getsize(dest) > 0
+        returncode, _ = _run_ffmpeg(cmd, timeout=90)
+        return returncode == 0 and os.path.getsize(dest) > 0
     except Exception as e:
         print(f"[Exporter] imageio-ffmpeg fallback error: {e}")
         return False
@@ -139,9 +346,12 @@ def export_unified_webm(
     output_dir: str,
     fps: int = 12,
     animation_duration_s: float = 3.0,
+    rgb: np.ndarray = None,
 ) -> str:
     """
     Create the PRIMARY unified talking sticker: WebM video + audio embedded.
+    `rgb` is the frames already flattened by _rgb_buffer, when the caller
+    shares them with other exporters.
 
     Returns:
         Path to the unified WebM sticker
@@ -150,24 +360,32 @@ def export_unified_webm(
     final_path = os.path.join(output_dir, f"{session_id}_sticker.webm")
     silent_path = os.path.join(output_dir, f"{session_id}_silent_tmp.webm")
 
-    if not frames:
+    if rgb is None:
+        rgb = _rgb_buffer(frames) if frames else None
+    if rgb is None:
         print("[Exporter] No frames — cannot create WebM")
         return ""
 
     print(f"[Exporter] Writing unified WebM ({len(frames)} frames @ {fps}fps)...")
 
+    has_audio = (
+        audio_mp3_path
+        and os.path.exists(audio_mp3_path)
+        and os.path.getsize(audio_mp3_path) > 1000
+    )
+
+    # Fast path: frames + voice encoded together in one ffmpeg pass
+    if has_audio and _encode_webm_with_audio(rgb, audio_mp3_path, fps, final_path):
+        print(f"[Exporter] OK: Unified WebM+audio -> {final_path}")
+        return final_path
+
     # Step 1: silent WebM
-    ok_silent = _frames_to_webm_silent(frames, fps, silent_path)
+    ok_silent = _frames_to_webm_silent(rgb, fps, silent_path)
     if not ok_silent:
         print("[Exporter] Silent WebM failed")
         return ""
 
     # Step 2: merge audio
-    has_audio = (
-        audio_mp3_path
-        and os.path.exists(audio_mp3_path)
-        and os.path.getsize(audio_mp3_path) > 1000
-    )
     if has_audio:
         merged = _merge_audio_ffmpeg(
             silent_path, audio_mp3_path, final_path, animation_duration_s
@@ -191,26 +409,32 @@ def export_unified_webm(
 # ─── Secondary: GIF ───────────────────────────────────────────────────────────
 
 
-def export_gif(frames: list, session_id: str, output_dir: str, fps: int = 12) -> str:
+def export_gif(
+    frames: list,
+    session_id: str,
+    output_dir: str,
+    fps: int = 12,
+    rgb: np.ndarray = None,
+) -> str:
     """Export animated GIF (secondary format, loop, solid bg for robust playback)."""
     os.makedirs(output_dir, exist_ok=True)
     dest = os.path.join(output_dir, f"{session_id}_sticker.gif")
-    if not frames:
+    if rgb is None:
+        rgb = _rgb_buffer(frames) if frames else None
+    if rgb is None:
         return ""
 
-    rgb_frames = []
-    for f in frames:
-        if isinstance(f, Image.Image):
-            bg = Image.new("RGB", f.size, (255, 255, 255))
-            if f.mode == "RGBA":
-                bg.paste(f, mask=f.split()[3])
-            else:
-                bg = f.convert("RGB")
-            rgb_frames.append(np.array(bg))
-
     try:
-        # Use imageio's GIF writer, which is vastly more reliable for looping animations
-        imageio.mimsave(dest, rgb_frames, format="GIF", fps=fps, loop=0)
+        # Solid background: the buffer is already matted, no transparency
+        gif_frames = quantize_frames(rgb)
+        gif_frames[0].save(
+            dest,
+            format="GIF",
+            save_all=True,
+            append_images=gif_frames[1:],
+            duration=int(1000 / fps),
+            loop=0,
+        )
         print(f"[Exporter] GIF -> {dest}")
         return dest
     except Exception as e:
@@ -221,6 +445,34 @@ def export_gif(frames: list, session_id: str, output_dir: str, fps: int = 12) ->
 # ─── Secondary: Animated WebP ─────────────────────────────────────────────────
 
 
+def _webp_with_img2webp(frames: list, frame_ms: int, dest: str) -> bool:
+    """
+    Encode an animated WebP with libwebp's img2webp tool, when installed.
+    It muxes the animation natively and can pick lossy or lossless per
+    frame (-mixed). Returns True on success.
+    """
+    img2webp = shutil.which("img2webp")
+    if not img2webp:
+        return False
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            cmd = [img2webp, "-loop", "0", "-mixed"]
+            cmd += ["-q", "85", "-m", "4", "-d", str(frame_ms)]
+            for i, frame in enumerate(frames):
+                path = os.path.join(tmp, f"f_{i:04d}.png")
+                frame.save(path, compress_level=1)
+                cmd.append(path)
+            cmd += ["-o", dest]
+            result = subprocess.run(cmd, capture_output=True, timeout=60)
+        if result.returncode == 0 and os.path.getsize(dest) > 0:
+            return True
+        err_tail = result.stderr[-300:].decode(errors="replace")
+        print(f"[Exporter] img2webp error: {err_tail}")
+    except Exception as e:
+        print(f"[Exporter] img2webp exception: {e}")
+    return False
+
+
 def export_animated_webp(
     frames: list, session_id: str, output_dir: str, fps: int = 12
 ) -> str:
@@ -230,9 +482,17 @@ def export_animated_webp(
     if not frames:
         return ""
     frame_ms = int(1000 / fps)
-    rgba = [f.convert("RGBA") for f in frames if isinstance(f, Image.Image)]
+    # Rendered frames are already RGBA — only convert the odd one out
+    rgba = [
+        f if f.mode == "RGBA" else f.convert("RGBA")
+        for f in frames
+        if isinstance(f, Image.Image)
+    ]
     if not rgba:
         return ""
+    if _webp_with_img2webp(rgba, frame_ms, dest):
+        print(f"[Exporter] WebP (img2webp) -> {dest}")
+        return dest
     try:
         rgba[0].save(
             dest,
@@ -271,27 +531,36 @@ def export_all_formats(
           "webp": path (secondary — WhatsApp/Telegram compatible),
         }
     """
-    frames = animation_result.get("frames", [])
+    render_frames = animation_result.get("render_frames")
+    frames = render_frames() if render_frames else []
     fps = animation_result.get("fps", 12)
     duration_s = animation_result.get("duration_s", 3.0)
 
     os.makedirs(output_dir, exist_ok=True)
-    exports = {}
-
-    # PRIMARY: unified WebM + voice
-    exports["webm"] = export_unified_webm(
-        frames=frames,
-        audio_mp3_path=audio_mp3_path,
-        session_id=session_id,
-        output_dir=output_dir,
-        fps=fps,
-        animation_duration_s=duration_s,
-    )
 
-    # SECONDARY: GIF
-    exports["gif"] = export_gif(frames, session_id, output_dir, fps)
+    # WebM and GIF both need the frames matted onto white; do it once into a
+    # single buffer rather than once per exporter while they run side by side
+    rgb = _rgb_buffer(frames) if frames else None
+
+    # The three formats share only the read-only frames and their encoders
+    # (ffmpeg, PIL) release the GIL, so encode them side by side
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        # PRIMARY: unified WebM + voice
+        webm = pool.submit(
+            export_unified_webm,
+            frames=frames,
+            audio_mp3_path=audio_mp3_path,
+            session_id=session_id,
+            output_dir=output_dir,
+            fps=fps,
+            animation_duration_s=duration_s,
+            rgb=rgb,
+        )
+
+        # SECONDARY: GIF
+        gif = pool.submit(export_gif, frames, session_id, output_dir, fps, rgb)
 
-    # SECONDARY: animated WebP
-    exports["webp"] = export_animated_webp(frames, session_id, output_dir, fps)
+        # SECONDARY: animated WebP
+        webp = pool.submit(export_animated_webp, frames, session_id, output_dir, fps)
 
-    return exports
+        return {"webm": webm.result(), "gif": gif.result(), "webp": webp.result()}
@@ -45,25 +45,51 @@ SUBJECT_MAP = {
 }
 
 
-def detect_subject(phrase: str) -> str:
-    phrase_lower = phrase.lower()
+# One scan over the phrase finds every subject and emotion keyword.
+# The lookahead reports overlapping hits; at each position the longest key
+# wins, so _KEYWORD_PREFIXES adds back shorter keys hidden underneath it.
+_KEYWORDS = list(dict.fromkeys([*SUBJECT_MAP, *EMOTION_MAP]))
+_KEYWORD_RE = re.compile(
+    "(?=(%s))" % "|".join(map(re.escape, sorted(_KEYWORDS, key=len, reverse=True)))
+)
+_KEYWORD_PREFIXES = {
+    key: frozenset(k for k in _KEYWORDS if key.startswith(k)) for key in _KEYWORDS
+}
+
+# Speech between quotes or guillemets: 'Salut !', "Hi", «Bonjour»
+_QUOTE_RE = re.compile(r"['\"\u00ab\u00bb]([^'\"<>]+)['\"\u00ab\u00bb]")
+
+
+def find_keywords(phrase: str) -> set:
+    """All SUBJECT_MAP / EMOTION_MAP keys occurring anywhere in the phrase."""
+    found = set()
+    for match in _KEYWORD_RE.finditer(phrase.lower()):
+        found |= _KEYWORD_PREFIXES[match.group(1)]
+    return found
+
+
+def detect_subject(phrase: str, keywords: set = None) -> str:
+    if keywords is None:
+        keywords = find_keywords(phrase)
+    # Map order decides priority when several keys occur
     for key, val in SUBJECT_MAP.items():
-        if key in phrase_lower:
+        if key in keywords:
             return val
     return "cute cartoon character"
 
 
-def detect_emotion_and_style(phrase: str):
-    phrase_lower = phrase.lower()
+def detect_emotion_and_style(phrase: str, keywords: set = None):
+    if keywords is None:
+        keywords = find_keywords(phrase)
     for key, (anim_style, visual_style) in EMOTION_MAP.items():
-        if key in phrase_lower:
+        if key in keywords:
             return anim_style, visual_style
     return "happy", "bright and colorful"
 
 
 def extract_speech_text(phrase: str) -> str:
     """Extract quoted speech text, or use the whole phrase."""
-    matches = re.findall(r"['\"\u00ab\u00bb]([^'\"<>]+)['\"\u00ab\u00bb]", phrase)
+    matches = _QUOTE_RE.findall(phrase)
     if matches:
         return matches[0]
     return phrase
@@ -97,8 +123,9 @@ def parse_phrase(phrase: str) -> dict:
     Returns:
         dict with keys: subject, emotion, speech_text, animation_style, image_style, image_prompt
     """
-    subject = detect_subject(phrase)
-    emotion, image_style = detect_emotion_and_style(phrase)
+    keywords = find_keywords(phrase)
+    subject = detect_subject(phrase, keywords)
+    emotion, image_style = detect_emotion_and_style(phrase, keywords)
     raw_speech_text = extract_speech_text(phrase)
 
     # NEW: Enhanced speech text with expressive tags
@@ -1,22 +1,40 @@
 import os
 import re
+import shutil
 import requests
+import threading
+from requests.adapters import HTTPAdapter
 import time
+from collections import OrderedDict
 from gtts import gTTS
 from dotenv import load_dotenv
 
+from pipeline.hf_retry import (
+    backoff_delay,
+    breaker_allows,
+    record_failure,
+    record_success,
+)
+
 load_dotenv()
 
 HF_TOKEN = os.getenv("HF_TOKEN")
 # Bark is excellent for expressive audio
 BARK_MODEL = "suno/bark-small"
 HF_API_URL = f"https://router.huggingface.co/hf-inference/models/{BARK_MODEL}"
-HEADERS = {"Authorization": f"Bearer {HF_TOKEN}"}
+# Wall-clock budget for 503 retries before falling back to gTTS
+BARK_RETRY_BUDGET_S = 30
 
+# Keep-alive session shared by all Bark calls and their retries
+_SESSION = requests.Session()
+_SESSION.headers.update({"Authorization": f"Bearer {HF_TOKEN}"})
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
 
-def detect_language(text: str) -> str:
-    """Simple language detection based on common French words."""
-    french_words = [
+# Word tokens for language detection
+_WORD_RE = re.compile(r"\b\w+\b")
+# Common French words; one hit is enough to pick French
+_FRENCH_WORDS = frozenset(
+    {
         "le",
         "la",
         "les",
@@ -61,17 +79,65 @@ def detect_language(text: str) -> str:
         "chat",
         "joyeux",
         "anniversaire",
-    ]
-    text_lower = text.lower()
-    words = re.findall(r"\b\w+\b", text_lower)
-    french_count = sum(1 for w in words if w in french_words)
-    if french_count >= 1:
-        return "fr"
-    return "en"
+    }
+)
+
+# Speaking rate used to estimate clip duration for lip-sync. gTTS averages
+# ~150 words/min (2.5 words/sec); we assume slightly slower for a more
+# natural feel, and Bark lands in the same range
+WORDS_PER_SECOND = 2.0
+
+# Tags and phrases that mark speech as emotional enough for Bark
+_EMO_RE = re.compile(
+    r"\[laughter\]|\[music\]|happy birthday|joyeux anniversaire|laughing", re.I
+)
+
+# (text, use_expressive, speed_slow) -> (audio path, file suffix, engine)
+# Identical speech across sessions reuses the clip instead of re-synthesizing
+VOICE_CACHE_SIZE = 256
+_voice_cache = OrderedDict()
+_voice_cache_lock = threading.Lock()
+
+
+def _cached_voice(key: tuple, session_id: str, output_dir: str):
+    """Copy a previously synthesized clip into this session, if still on disk."""
+    with _voice_cache_lock:
+        entry = _voice_cache.get(key)
+        if entry is None:
+            return None
+        _voice_cache.move_to_end(key)
+    src_path, suffix, engine = entry
+    dest_path = os.path.join(output_dir, f"{session_id}{suffix}")
+    try:
+        shutil.copyfile(src_path, dest_path)
+    except OSError:
+        with _voice_cache_lock:
+            _voice_cache.pop(key, None)
+        return None
+    return dest_path, engine
+
+
+def _remember_voice(key: tuple, audio_path: str, session_id: str, engine: str):
+    suffix = os.path.basename(audio_path)[len(session_id) :]
+    with _voice_cache_lock:
+        _voice_cache[key] = (audio_path, suffix, engine)
+        _voice_cache.move_to_end(key)
+        while len(_voice_cache) > VOICE_CACHE_SIZE:
+            _voice_cache.popitem(last=False)
+
+
+def detect_language(text: str) -> str:
+    """Simple language detection based on common French words."""
+    words = _WORD_RE.findall(text.lower())
+    return "fr" if any(w in _FRENCH_WORDS for w in words) else "en"
 
 
 def generate_voice_bark(text: str, session_id: str, output_dir: str) -> str:
     """Generate expressive audio using Bark via HuggingFace Inference API."""
+    if not HF_TOKEN:
+        print("[Bark] HF_TOKEN not set. Skipping to gTTS.")
+        return None
+
     mp3_path = os.path.join(output_dir, f"{session_id}_voice_bark.mp3")
 
     # Bark tags: [laughter], [whispering], [musical], [clears throat], etc.
@@ -85,25 +151,42 @@ def generate_voice_bark(text: str, session_id: str, output_dir: str) -> str:
 
     # Bark API expectation: simple text input
     # It returns audio/flac or audio/mpeg
+    if not breaker_allows(BARK_MODEL):
+        print("[Bark] Circuit open. Skipping to gTTS.")
+        return None
+
+    # Loading (503) retries don't count against the breaker; giving up does
     retries = 3
+    deadline = time.monotonic() + BARK_RETRY_BUDGET_S
     for i in range(retries):
         try:
-            response = requests.post(
-                HF_API_URL, headers=HEADERS, json={"inputs": text}, timeout=60
-            )
+            response = _SESSION.post(HF_API_URL, json={"inputs": text}, timeout=60)
             if response.status_code == 200:
                 with open(mp3_path, "wb") as f:
                     f.write(response.content)
+                record_success(BARK_MODEL)
                 return mp3_path
             elif response.status_code == 503:
+                if i == retries - 1:
+                    # No retry left to wait for — fall back to gTTS now
+                    print("[Bark] Model still loading. Skipping to gTTS.")
+                    record_failure(BARK_MODEL)
+                    break
+                wait_time = backoff_delay(i, response.json().get("estimated_time"))
+                if time.monotonic() + wait_time > deadline:
+                    print("[Bark] Retry budget spent while model loads.")
+                    record_failure(BARK_MODEL)
+                    break
                 print(
-                    f"[Bark] Model loading (503), retrying in 10s... ({i + 1}/{retries})"
+                    f"[Bark] Model loading (503), retrying in {wait_time:.1f}s... ({i + 1}/{retries})"
                 )
-                time.sleep(10)
+                time.sleep(wait_time)
             else:
+                record_failure(BARK_MODEL)
                 print(f"[Bark] Error {response.status_code}: {response.text}")
                 break
         except Exception as e:
+            record_failure(BARK_MODEL)
             print(f"[Bark] Exception: {e}")
             break
     return None
@@ -126,21 +209,19 @@ def generate_voice(
     # Decide between Bark (Expressive) and gTTS (Standard)
     # We use Bark if 'expressive' is requested AND it's likely a short emotional phrase
     # or if it contains special tags.
-    is_emotional = any(
-        tag in text.lower()
-        for tag in [
-            "[laughter]",
-            "[music]",
-            "happy birthday",
-            "joyeux anniversaire",
-            "laughing",
-        ]
-    )
+    is_emotional = bool(_EMO_RE.search(text))
 
     audio_path = None
     engine = "gTTS"
 
-    if use_expressive and (is_emotional or len(text) < 150):
+    cache_key = (text, use_expressive, speed_slow)
+    cached = _cached_voice(cache_key, session_id, output_dir)
+    if cached:
+        audio_path, engine = cached
+        print(f"[TTS] Reusing cached voice via {engine}")
+
+    wants_bark = use_expressive and (is_emotional or len(text) < 150)
+    if not audio_path and wants_bark:
         audio_path = generate_voice_bark(text, session_id, output_dir)
         if audio_path:
             engine = "Bark (Expressive AI)"
@@ -159,12 +240,15 @@ def generate_voice(
         audio_path = mp3_path
         engine = "gTTS (Standard)"
 
-    # Estimate duration: average 150 words/min = 2.5 words/sec for gTTS
-    # Bark might be slightly different but this is a good baseline for lip-sync
+    # A gTTS fallback for a Bark request is only a stand-in: don't let it
+    # answer the same request again once Bark is back
+    fallback = wants_bark and engine.startswith("gTTS")
+    if not cached and not fallback:
+        _remember_voice(cache_key, audio_path, session_id, engine)
+
+    # Estimate duration from the speaking rate; a good baseline for lip-sync
     word_count = len(text.replace("[", "").replace("]", "").split())
-    duration_estimate = max(
-        1.5, word_count / 2.0
-    )  # slightly slower for more natural feel
+    duration_estimate = max(1.5, word_count / WORDS_PER_SECOND)
 
     print(f"[TTS] Voice saved -> {audio_path} (~{duration_estimate:.1f}s) via {engine}")
 
@@ -174,4 +258,5 @@ def generate_voice(
         "language": language,
         "text": text,
         "engine": engine,
+        "fallback": fallback,
     }
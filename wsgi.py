@@ -0,0 +1,8 @@
+"""
+ChattyStickers — WSGI entry point
+Production server: gunicorn -w 4 -k gthread --threads 8 -b 0.0.0.0:5000 wsgi:application
+"""
+
+from app import app
+
+application = app